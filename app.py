@@ -1,18 +1,25 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 from configparser import ConfigParser
+from tsdownsample import LTTBDownsampler
 from database import DatabaseManager
 from truedata_feed import TrueDataFeed
 from datetime import datetime
 import time
-import random
+import math
 
 # Constants
 SYMBOLS = ["NIFTY 50","NIFTY BANK","MCXCOMPDEX","AARTIIND","BRITANNIA",
 "COLPAL","DMART","EICHERMOT","GILLETTE","HDFCBANK","ICICIBANK","JKTYRE","KAJARIACER",
 "LICHSGFIN","MINDTREE","OFSS","PNB","QUICKHEAL","RELIANCE","SBIN","TCS","UJJIVAN",
 "WIPRO","YESBANK","ZEEL","NIFTY31JulFUT", "NIFTY-I","BANKNIFTY-I","CRUDEOIL-I","GOLDM-I","SILVERM-I","COPPER-I", "SILVER-I"]
+SYMBOLS_KEY = tuple(SYMBOLS)  # Cheap, stable cache key for the symbol list
+CHART_COLUMNS = 2
+CHART_HEIGHT = 300  # Pixels per row of chart panels
+MAX_CHART_POINTS = 400  # LTTB guard per chart; above the ~300 history buckets per symbol
 
 # PAGE CONFIG
 st.set_page_config(
@@ -22,115 +29,247 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-@st.cache_data(ttl=1)
-def get_recent_data(symbols, hours=24):
-    """Fetch recent data"""
+@st.cache_resource
+def init_database():
+    """Create the connection pool and bring the schema up to date, once per process"""
+    DatabaseManager.initialize()
+    DatabaseManager.initialize_tables()
+
+def cache_bucket(seconds):
+    """Current wall-clock bucket index, used to coalesce cache keys across reruns"""
+    return int(time.time()) // seconds
+
+def to_frame(results):
+    """Build a (symbol, ts, ltp) frame column-wise with compact dtypes"""
+    if not results:
+        return pd.DataFrame(columns=['symbol', 'ts', 'ltp'])
+    symbols, timestamps, prices = zip(*results)
+    return pd.DataFrame({
+        'symbol': pd.Categorical(symbols),
+        'ts': pd.to_datetime(timestamps, utc=True),
+        'ltp': np.asarray(prices, dtype=np.float64)
+    })
+
+@st.cache_data(ttl=2, hash_funcs={list: tuple})
+def get_latest_prices(symbols, end_bucket):
+    """Fetch the most recent tick for each symbol (cached per `end_bucket`)"""
     if not symbols:
         return pd.DataFrame(columns=['symbol', 'ts', 'ltp'])
-        
+
+    # One (symbol, ts DESC) index seek per requested symbol
     query = """
-        SELECT symbol, ts AT TIME ZONE 'UTC' as ts, ltp 
-        FROM truedata_realtime 
-        WHERE symbol = ANY(%s) 
-        AND ts >= NOW() - INTERVAL '%s hours'
-        ORDER BY ts
+        SELECT wanted.symbol, t.ts, t.ltp
+        FROM unnest(%s::text[]) AS wanted(symbol)
+        CROSS JOIN LATERAL (
+            SELECT ts, ltp
+            FROM truedata_realtime
+            WHERE symbol = wanted.symbol
+            ORDER BY truedata_realtime.ts DESC
+            LIMIT 1
+        ) t
     """
     try:
-        results = DatabaseManager.execute_query(query, (symbols, hours))
-        if results:
-            df = pd.DataFrame(results, columns=['symbol', 'ts', 'ltp'])
-            df['ts'] = pd.to_datetime(df['ts'])
-            return df
+        results = DatabaseManager.execute_query(query, (list(symbols),))
+        return to_frame(results)
+    except Exception as e:
+        st.error(f"Data fetch error: {str(e)}")
+        return pd.DataFrame(columns=['symbol', 'ts', 'ltp'])
+
+@st.cache_data(ttl=5, hash_funcs={list: tuple})
+def get_history_buckets(symbols, end_bucket, hours=24, buckets=300):
+    """Fetch recent history downsampled to at most `buckets` points per symbol"""
+    if not symbols:
         return pd.DataFrame(columns=['symbol', 'ts', 'ltp'])
+
+    bucket_seconds = max(1, int(hours * 3600 / buckets))
+    # Per-symbol index range scans instead of one ANY() bitmap scan
+    query = """
+        SELECT wanted.symbol, b.ts, b.ltp
+        FROM unnest(%s::text[]) AS wanted(symbol)
+        CROSS JOIN LATERAL (
+            SELECT time_bucket(%s::interval, ts) as ts, last(ltp, ts) as ltp
+            FROM truedata_realtime
+            WHERE symbol = wanted.symbol
+            AND ts > (NOW() AT TIME ZONE 'UTC') - %s::interval
+            GROUP BY 1
+        ) b
+    """
+    try:
+        results = DatabaseManager.execute_query(
+            query, (list(symbols), f"{bucket_seconds} seconds", f"{hours} hours"))
+        return to_frame(results)
     except Exception as e:
         st.error(f"Data fetch error: {str(e)}")
         return pd.DataFrame(columns=['symbol', 'ts', 'ltp'])
 
-def create_ui(df, update_counter):
-    """Create the complete UI inside the placeholder"""
+def lttb_indices(x, y, n_out=MAX_CHART_POINTS):
+    """Indices of n_out visually representative points of (x, y) (LTTB)"""
+    if len(x) <= n_out:
+        return slice(None)
+    return LTTBDownsampler().downsample(x, y, n_out=n_out)
+
+def series_bytes(symbol_df):
+    """Pack a symbol's ts (ns), ltp and MA_10 columns into one hashable buffer"""
+    ts_ns = symbol_df['ts'].to_numpy(dtype='datetime64[ns]').view('int64')
+    return (ts_ns.tobytes()
+            + symbol_df['ltp'].to_numpy(dtype='float64').tobytes()
+            + symbol_df['MA_10'].to_numpy(dtype='float64').tobytes())
+
+@st.cache_data(max_entries=128)
+def build_symbol_traces(symbol, last_ts_ns, xy_bytes):
+    """Downsampled WebGL price (+ 10-period MA) traces for one symbol"""
+    n = len(xy_bytes) // 24
+    ts_ns = np.frombuffer(xy_bytes, dtype=np.int64, count=n)
+    ltp = np.frombuffer(xy_bytes, dtype=np.float64, count=n, offset=8 * n)
+    ma = np.frombuffer(xy_bytes, dtype=np.float64, count=n, offset=16 * n)
+    
+    idx = lttb_indices(ts_ns, ltp)
+    x = ts_ns[idx].view('datetime64[ns]')
+    traces = [go.Scattergl(
+        x=x,
+        y=ltp[idx],
+        mode='lines',
+        name='Price',
+        legendgroup='price',
+        line=dict(color='#1f77b4')
+    )]
+    
+    if n > 10:
+        traces.append(go.Scattergl(
+            x=x, 
+            y=ma[idx], 
+            mode='lines',
+            name='10-period MA',
+            legendgroup='ma',
+            line=dict(color='orange', width=2)
+        ))
+    return traces
+
+def build_chart_grid(groups):
+    """Build one faceted WebGL figure with a price + 10-period MA panel per symbol"""
+    rows = math.ceil(len(SYMBOLS) / CHART_COLUMNS)
+    titles = [symbol if symbol in groups else f"{symbol} - No data available"
+              for symbol in SYMBOLS]
+    fig = make_subplots(rows=rows, cols=CHART_COLUMNS, subplot_titles=titles,
+                        vertical_spacing=0.3 / rows, horizontal_spacing=0.06)
+    
+    in_legend = set()  # One legend entry per series across all panels
+    for i, symbol in enumerate(SYMBOLS):
+        symbol_df = groups.get(symbol)
+        if symbol_df is None:
+            continue
+        row, col = i // CHART_COLUMNS + 1, i % CHART_COLUMNS + 1
+        # Symbols whose latest data is unchanged come straight from the cache
+        xy_bytes = series_bytes(symbol_df)
+        last_ts_ns = symbol_df['ts'].iloc[-1].value
+        for trace in build_symbol_traces(symbol, last_ts_ns, xy_bytes):
+            trace.showlegend = trace.legendgroup not in in_legend
+            in_legend.add(trace.legendgroup)
+            fig.add_trace(trace, row=row, col=col)
+    
+    fig.update_layout(
+        height=CHART_HEIGHT * rows,
+        margin=dict(l=20, r=20, t=50, b=20),
+        showlegend=True
+    )
+    return fig
+
+def price_change_color(value):
+    """Cell style for a price change: green up, red down"""
+    if value > 0:
+        return 'color: green'
+    if value < 0:
+        return 'color: red'
+    return ''
+
+def create_ui(latest_df, df, live_prices=None):
+    """Create the price and chart tabs; live_prices override the stored latest prices"""
+    groups = {}
+    if not df.empty:
+        # The query returns rows unordered; sort once here for the rolling MA.
+        # One grouped rolling pass for all symbols, then split once per rerun
+        df = df.sort_values(['symbol', 'ts'], kind='mergesort')
+        df['MA_10'] = (df.groupby('symbol', sort=False, observed=True)['ltp']
+                       .rolling(10).mean()
+                       .reset_index(level=0, drop=True))
+        groups = dict(iter(df.groupby('symbol', sort=False, observed=True)))
+
     # Create tabs
     tab1, tab2 = st.tabs(["Current Prices", "Price Charts"])
     
     with tab1:
         st.header("Current Market Prices")
-        current_prices = {}
+        current_prices, prev_prices = {}, {}
+        if not latest_df.empty:
+            current_prices = latest_df.set_index('symbol')['ltp'].to_dict()
+        if live_prices:
+            current_prices.update(live_prices)
         if not df.empty:
-            latest_data = df.sort_values('ts').groupby('symbol').last().reset_index().copy()
-            current_prices = latest_data.set_index('symbol')['ltp'].to_dict()
+            # Second-to-last history bucket per symbol
+            prev_rows = df[df.groupby('symbol', sort=False, observed=True).cumcount(ascending=False) == 1]
+            prev_prices = prev_rows.set_index('symbol')['ltp'].to_dict()
+        
+        # Build the table column-wise and render it as a single element
+        prices = pd.DataFrame({'Symbol': SYMBOLS})
+        prices['Price'] = prices['Symbol'].map(current_prices).astype(float)
+        prev = prices['Symbol'].map(prev_prices).astype(float)
+        prices['Δ'] = prices['Price'] - prev
+        prices['Δ%'] = prices['Δ'] / prev * 100
         
-        cols = st.columns(4)
-        for i, symbol in enumerate(SYMBOLS):
-            with cols[i % 4]:
-                price = current_prices.get(symbol, None)
-                if price is not None:
-                    symbol_df = df[df['symbol'] == symbol].copy()
-                    if len(symbol_df) > 1:
-                        prev_price = symbol_df.iloc[-2]['ltp']
-                        delta = price - prev_price
-                        delta_pct = (delta / prev_price) * 100
-                        st.metric(
-                            label=symbol,
-                            value=f"{price:.2f}",
-                            delta=f"{delta:.2f} ({delta_pct:.2f}%)"
-                        )
-                    else:
-                        st.metric(label=symbol, value=f"{price:.2f}")
-                else:
-                    st.metric(label=symbol, value="N/A")
+        styled = (prices.style
+                  .format({'Price': '{:.2f}', 'Δ': '{:+.2f}', 'Δ%': '{:+.2f}%'}, na_rep='N/A')
+                  .map(price_change_color, subset=['Δ', 'Δ%']))
+        st.dataframe(styled, hide_index=True, use_container_width=True)
     
     with tab2:
         st.header("Price Charts")
-        cols = st.columns(2)
-        for i, symbol in enumerate(SYMBOLS):
-            with cols[i % 2]:
-                symbol_df = df[df['symbol'] == symbol].copy() if not df.empty else pd.DataFrame()
-                
-                if not symbol_df.empty:
-                    if len(symbol_df) > 10:
-                        symbol_df.loc[:, 'MA_10'] = symbol_df['ltp'].rolling(10).mean()
-                    
-                    fig = px.line(symbol_df, x='ts', y='ltp',
-                                labels={'ts': 'Time', 'ltp': 'Price'},
-                                title=f"{symbol}",
-                                height=300)
-                    
-                    if 'MA_10' in symbol_df.columns:
-                        fig.add_scatter(
-                            x=symbol_df['ts'], 
-                            y=symbol_df['MA_10'], 
-                            name='10-period MA',
-                            line=dict(color='orange', width=2)
-                        )
-                    
-                    fig.update_layout(
-                        height=300,
-                        margin=dict(l=20, r=20, t=50, b=20),
-                        showlegend=True,
-                        title_x=0.5
-                    )
-                    st.plotly_chart(
-                        fig, 
-                        use_container_width=True,
-                        key=f"chart_{symbol}_{update_counter}_{random.random()}"
-                    )
-                else:
-                    fig = px.line(title=f"{symbol} - No data available")
-                    fig.update_layout(
-                        height=300,
-                        margin=dict(l=20, r=20, t=50, b=20),
-                        xaxis=dict(showgrid=False),
-                        yaxis=dict(showgrid=False),
-                        title_x=0.5
-                    )
-                    st.plotly_chart(
-                        fig, 
-                        use_container_width=True,
-                        key=f"empty_chart_{symbol}_{update_counter}_{random.random()}"
-                    )
+        # Rebuild the grid only when some symbol's series changed
+        signature = tuple(
+            (symbol, len(g), g['ts'].iloc[0], g['ts'].iloc[-1], g['ltp'].iloc[-1])
+            for symbol, g in groups.items()
+        )
+        cached = st.session_state.chart_grid
+        if cached is not None and cached[0] == signature:
+            fig = cached[1]
+        else:
+            fig = build_chart_grid(groups)
+            st.session_state.chart_grid = (signature, fig)
+        st.plotly_chart(fig, use_container_width=True, key="all_charts")
+
+@st.fragment(run_every=1.0)
+def connection_status():
+    """Sidebar connection status; re-runs on its own so a dropped websocket shows up"""
+    if not st.session_state.connection_active:
+        status = "⚠️ Disconnected"
+    elif st.session_state.data_feed.is_connection_healthy():
+        status = "✅ Connected"
+    else:
+        status = "⚠️ Connection lost"
+    st.markdown(f"**Connection Status:** {status}")
+
+@st.fragment(run_every=1.0)
+def live_dashboard():
+    """Redraw the tabs from the database; re-runs on its own every second"""
+    # Ticks are persisted by the feed's writer thread; only surface its messages here
+    data_feed = st.session_state.data_feed
+    data_feed.process_messages()
+
+    col1, col2 = st.columns(2)
+    col1.metric("Ticks stored", f"{data_feed.rows_written:,}")
+    last_tick = data_feed.last_tick_ts
+    col2.metric("Last tick (UTC)", last_tick.strftime('%H:%M:%S') if last_tick else "N/A")
+
+    latest_df = get_latest_prices(SYMBOLS_KEY, cache_bucket(2))
+    df = get_history_buckets(SYMBOLS_KEY, cache_bucket(5), hours=4)
+    create_ui(latest_df, df, data_feed.latest_prices())
 
 def main():
-    # Initialize database
-    DatabaseManager.initialize()
+    # Initialize database (failures are not cached, so the next rerun retries)
+    try:
+        init_database()
+    except Exception as e:
+        st.error(f"Database setup failed: {str(e)}")
+        st.stop()
 
     # Load config
     config = ConfigParser()
@@ -145,9 +284,7 @@ def main():
         )
         st.session_state.processing_active = False
         st.session_state.connection_active = False
-        st.session_state.last_update = 0
-        st.session_state.update_counter = 0
-        st.session_state.placeholder = st.empty()
+        st.session_state.chart_grid = None
 
     # Control Panel in Sidebar
     with st.sidebar:
@@ -179,8 +316,7 @@ def main():
         st.divider()
         
         # Status indicators
-        connection_status = "✅ Connected" if st.session_state.connection_active else "⚠️ Disconnected"
-        st.markdown(f"**Connection Status:** {connection_status}")
+        connection_status()
         
         status_color = "green" if st.session_state.processing_active else "gray"
         status_text = "▶ Processing" if st.session_state.processing_active else "⏹ Stopped"
@@ -205,8 +341,6 @@ def main():
     if start_btn:
         if st.session_state.data_feed.start_processing():
             st.session_state.processing_active = True
-            st.session_state.last_update = 0
-            st.session_state.update_counter = 0
             st.rerun()  
 
     if stop_btn:
@@ -217,43 +351,13 @@ def main():
     # Process UI messages
     st.session_state.data_feed.process_messages()
 
-    # Main title (outside the placeholder so it doesn't refresh)
+    # Main title (outside the fragment so it doesn't refresh)
     st.title("📊 TrueData Real-Time Market Dashboard")
 
-    # Initial data load
-    df = get_recent_data(SYMBOLS, hours=4)
-    
-    # Main UI update loop
-    while True:
-        # Update the entire UI inside the placeholder
-
-        if st.session_state.connection_active == False:
-            st.session_state.data_feed.disconnection()
-
-        with st.session_state.placeholder.container():
-            create_ui(df, st.session_state.update_counter)
-
-        # If processing is active, check for updates
-        if st.session_state.processing_active:
-            current_time = time.time()
-            
-            # Update every 1 second
-            if current_time - st.session_state.last_update >= 1.0:
-                # Get fresh data
-                df = get_recent_data(SYMBOLS, hours=4)
-
-                # Increment counter for unique chart keys
-                st.session_state.update_counter += 1
-                
-                # Process any new data
-                st.session_state.data_feed.check_for_updates()
-                st.session_state.data_feed.process_queue()
-                
-                # Update last update time
-                st.session_state.last_update = current_time
-        
-        # Small sleep to prevent CPU overload
-        time.sleep(10)
+    if st.session_state.connection_active == False:
+        st.session_state.data_feed.disconnection()
+
+    live_dashboard()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
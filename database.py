@@ -1,41 +1,83 @@
+import io
+import threading
 import psycopg2
-from psycopg2 import pool
+import psycopg2.errors
+from psycopg2 import pool, sql
 from configparser import ConfigParser
 
+def _copy_text(value):
+    """Render one value for COPY ... FORMAT text"""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
 class DatabaseManager:
     _connection_pool = None
+    _init_lock = threading.Lock()
+    _tls = threading.local()
+    _prepared = {}  # Statement name -> (SQL, parameter types), prepared lazily on each connection
 
     @classmethod
     def initialize(cls):
-        config = ConfigParser()
-        config.read('config.ini')
-        cls._connection_pool = pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
-            host=config['postgresql']['host'],
-            database=config['postgresql']['database'],
-            user=config['postgresql']['user'],
-            password=config['postgresql']['password']
-        )
+        with cls._init_lock:
+            if cls._connection_pool is not None:
+                return
+            config = ConfigParser()
+            config.read('config.ini')
+            cls._connection_pool = pool.ThreadedConnectionPool(
+                minconn=2,
+                maxconn=16,
+                host=config['postgresql']['host'],
+                database=config['postgresql']['database'],
+                user=config['postgresql']['user'],
+                password=config['postgresql']['password']
+            )
 
     @classmethod
     def get_connection(cls):
+        conn = getattr(cls._tls, 'conn', None)
+        if conn is not None:
+            if not conn.closed:
+                return conn
+            # Pinned connection was lost: discard it and pin a fresh one
+            cls._tls.conn = None
+            cls._connection_pool.putconn(conn, close=True)
+            cls._tls.conn = cls._connection_pool.getconn()
+            return cls._tls.conn
         if cls._connection_pool is None:
             cls.initialize()
         return cls._connection_pool.getconn()
 
     @classmethod
     def return_connection(cls, connection):
+        if connection is getattr(cls._tls, 'conn', None):
+            return  # Held by this thread until release_thread()
         if cls._connection_pool and connection:
             cls._connection_pool.putconn(connection)
 
+    @classmethod
+    def bind_thread(cls):
+        """Pin one pooled connection to the calling (long-lived) thread"""
+        if getattr(cls._tls, 'conn', None) is None:
+            cls._tls.conn = cls.get_connection()
+
+    @classmethod
+    def release_thread(cls):
+        """Return the calling thread's pinned connection to the pool"""
+        conn = getattr(cls._tls, 'conn', None)
+        cls._tls.conn = None
+        cls.return_connection(conn)
+
     @classmethod
     def execute_query(cls, query, params=None):
         conn = cls.get_connection()
+        is_select = query.strip().upper().startswith('SELECT')
         try:
+            conn.autocommit = is_select  # No implicit transaction for reads
             with conn.cursor() as cur:
                 cur.execute(query, params or ())
-                if query.strip().upper().startswith('SELECT'):
+                if is_select:
                     return cur.fetchall()
                 conn.commit()
         except Exception as e:
@@ -44,18 +86,161 @@ class DatabaseManager:
         finally:
             cls.return_connection(conn)
 
+    @classmethod
+    def prepare(cls, name, statement, arg_types):
+        """Register a server-side prepared statement (parameters $1, $2, ... of arg_types)"""
+        cls._prepared[name] = (statement, tuple(arg_types))
+
+    @classmethod
+    def execute_prepared(cls, name, params):
+        """EXECUTE a prepared statement, preparing it on this connection if needed; returns rowcount"""
+        statement, arg_types = cls._prepared[name]
+        # Cast every argument: e.g. an all-None list is sent as ARRAY[NULL,...] (text[])
+        types = [sql.SQL(arg_type) for arg_type in arg_types]
+        execute = sql.SQL("EXECUTE {} ({})").format(
+            sql.Identifier(name),
+            sql.SQL(', ').join(sql.SQL("%s::{}").format(t) for t in types))
+        conn = cls.get_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                try:
+                    cur.execute(execute, params)
+                except psycopg2.errors.InvalidSqlStatementName:
+                    # First use on this connection: roll back the failed EXECUTE, then PREPARE
+                    conn.rollback()
+                    cur.execute(sql.SQL("PREPARE {} ({}) AS ").format(
+                        sql.Identifier(name), sql.SQL(', ').join(types)) + sql.SQL(statement))
+                    cur.execute(execute, params)
+                rowcount = cur.rowcount
+            conn.commit()
+            return rowcount
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            cls.return_connection(conn)
+
+    @classmethod
+    def copy_rows(cls, table, columns, rows):
+        """Bulk-load rows with COPY via a temp stage table, skipping duplicate keys; returns rows inserted"""
+        if not rows:
+            return 0
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(_copy_text(value) for value in row))
+            buf.write('\n')
+        buf.seek(0)
+
+        stage = sql.Identifier(f"{table}_stage")
+        target = sql.Identifier(table)
+        cols = sql.SQL(', ').join(map(sql.Identifier, columns))
+        conn = cls.get_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL(
+                    "CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP"
+                ).format(stage, target))
+                cur.copy_expert(sql.SQL(
+                    "COPY {} ({}) FROM STDIN WITH (FORMAT text)"
+                ).format(stage, cols), buf)
+                cur.execute(sql.SQL(
+                    "INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING"
+                ).format(target, cols, cols, stage))
+                rowcount = cur.rowcount
+            conn.commit()
+            return rowcount
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            cls.return_connection(conn)
+
     @classmethod
     def initialize_tables(cls):
-        """Initialize a simple non-partitioned table"""
+        """Initialize the tick table as a compressed TimescaleDB hypertable"""
         create_table_query = """
+            CREATE EXTENSION IF NOT EXISTS timescaledb;
+
+            -- create_hypertable cannot convert a natively partitioned table:
+            -- keep it aside as truedata_realtime_legacy and copy its rows below
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM pg_class
+                    WHERE oid = to_regclass('truedata_realtime') AND relkind = 'p'
+                ) THEN
+                    ALTER TABLE truedata_realtime RENAME TO truedata_realtime_legacy;
+                END IF;
+            END $$;
+
             CREATE TABLE IF NOT EXISTS truedata_realtime (
                 symbol VARCHAR(50) NOT NULL,
-                ts TIMESTAMPTZ NOT NULL,
-                ltp DECIMAL(15, 2),
+                ts TIMESTAMP NOT NULL,  -- UTC
+                ltp DOUBLE PRECISION,
                 volume BIGINT,
                 PRIMARY KEY (symbol, ts)
             );
-            
-            CREATE INDEX IF NOT EXISTS idx_truedata_symbol_ts ON truedata_realtime (symbol, ts);
+
+            DO $$
+            BEGIN
+                IF to_regclass('truedata_realtime_legacy') IS NOT NULL
+                   AND NOT EXISTS (SELECT 1 FROM truedata_realtime) THEN
+                    INSERT INTO truedata_realtime (symbol, ts, ltp, volume)
+                    SELECT symbol, ts AT TIME ZONE 'UTC', ltp::double precision, volume
+                    FROM truedata_realtime_legacy
+                    ON CONFLICT DO NOTHING;
+                    RAISE NOTICE 'Copied truedata_realtime_legacy into truedata_realtime; drop it once verified';
+                END IF;
+            END $$;
+
+            -- Narrow tables created with the old TIMESTAMPTZ/DECIMAL columns
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'truedata_realtime' AND column_name = 'ts'
+                    AND data_type = 'timestamp with time zone'
+                ) THEN
+                    IF EXISTS (
+                        SELECT 1 FROM timescaledb_information.hypertables
+                        WHERE hypertable_name = 'truedata_realtime' AND compression_enabled
+                    ) THEN
+                        -- Naive UTC writes into TIMESTAMPTZ would be shifted by the
+                        -- session TimeZone, so refuse to start rather than store them
+                        RAISE EXCEPTION 'truedata_realtime is compressed; decompress it so ts can be migrated to UTC TIMESTAMP';
+                    ELSE
+                        ALTER TABLE truedata_realtime
+                            ALTER COLUMN ts TYPE TIMESTAMP USING ts AT TIME ZONE 'UTC',
+                            ALTER COLUMN ltp TYPE DOUBLE PRECISION USING ltp::double precision;
+                    END IF;
+                END IF;
+            END $$;
+
+            SELECT create_hypertable('truedata_realtime', 'ts',
+                                     chunk_time_interval => INTERVAL '1 day',
+                                     if_not_exists => TRUE,
+                                     migrate_data => TRUE);
+
+            DROP INDEX IF EXISTS idx_truedata_symbol_ts;
+            CREATE INDEX IF NOT EXISTS idx_truedata_symbol_ts_desc
+                ON truedata_realtime (symbol, ts DESC) INCLUDE (ltp);
+
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM timescaledb_information.hypertables
+                    WHERE hypertable_name = 'truedata_realtime' AND compression_enabled
+                ) THEN
+                    ALTER TABLE truedata_realtime SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'symbol'
+                    );
+                END IF;
+            END $$;
+
+            SELECT add_compression_policy('truedata_realtime', INTERVAL '7 days',
+                                          if_not_exists => TRUE);
         """
         cls.execute_query(create_table_query)
\ No newline at end of file
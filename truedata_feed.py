@@ -1,23 +1,59 @@
 from truedata_ws.websocket.TD import TD
 from datetime import datetime, timezone
+import os
 import queue
+import threading
+from collections import deque
+from operator import attrgetter
 import streamlit as st
 from database import DatabaseManager
-from copy import deepcopy
 import time
 
+BATCH_SIZE = 500  # Max rows per INSERT round-trip
+COPY_THRESHOLD = 200  # Batches larger than this are loaded with COPY
+TICK_COLUMNS = ('symbol', 'ts', 'ltp', 'volume')  # Field order of queued tick tuples
+_UTC = timezone.utc
+INSERT_TICKS_SQL = """
+    INSERT INTO truedata_realtime (symbol, ts, ltp, volume)
+    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::float8[], $4::bigint[])
+    ON CONFLICT (symbol, ts) DO NOTHING
+"""
+INSERT_TICKS_TYPES = ('text[]', 'timestamp[]', 'float8[]', 'bigint[]')
+_extract_tick = attrgetter('symbol', 'ltp', 'timestamp', 'ttq')
+FLUSH_INTERVAL = 0.5  # Max seconds a tick waits in the queue before being stored
+HEALTH_CHECK_INTERVAL = 0.5  # Seconds a websocket health probe result is reused
+MSG_DEDUP_WINDOW = 1.0  # Seconds an identical message is suppressed for
+MAX_TOASTS = 3  # Toasts shown per process_messages call; older ones are dropped
+MAX_PENDING_TICKS = 100_000  # Ring buffer size; oldest ticks are dropped beyond this
+
 class TrueDataFeed:
-    def __init__(self, username, password, symbols):
+    def __init__(self, username, password, symbols, flush_interval=FLUSH_INTERVAL,
+                 writer_cpu=None):
         self.username = username
         self.password = password
         self.symbols = symbols
-        self.data_queue = queue.Queue()
+        self.flush_interval = flush_interval
+        self.writer_cpu = writer_cpu  # Optional CPU to pin the writer thread to (Linux)
+        # SPSC ring buffer (websocket thread -> writer thread); append/popleft
+        # are atomic under the GIL, so there is no per-item lock or wakeup
+        self.data_queue = deque(maxlen=MAX_PENDING_TICKS)
         self.message_queue = queue.Queue()
         self.td_app = None
         self.req_ids = []
-        self._last_data = {}
+        self._aware_ts = False
+        self._latest = {}  # symbol -> (ts, ltp, volume) of its newest tick
+        # Plain attributes the UI reads directly; each has a single writer thread
+        self.rows_written = 0
+        self.last_tick_ts = None
         self._processing_active = False
         self._connection_active = False
+        self._writer_thread = None
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()  # Set when a full batch is waiting, or on stop
+        self._last_msg_key = None
+        self._last_health = False
+        self._last_health_check = float('-inf')
+        self._last_msg_time = 0.0
 
     def connection(self):
         """Establish connection to TrueData service"""
@@ -29,11 +65,13 @@ class TrueDataFeed:
             self.td_app = TD(self.username, self.password,
                            live_port=8082,
                            historical_api=False)
+            # Ticks are pushed from the websocket thread; no polling
+            self.td_app.trade_callback(self._on_tick)
             self._connection_active = True
-            self.message_queue.put(("toast", "Connected to TrueData service!", "✅"))
+            self._notify("toast", "Connected to TrueData service!", "✅")
             return True
         except Exception as e:
-            self.message_queue.put(("error", f"Connection failed: {str(e)}"))
+            self._notify("error", f"Connection failed: {str(e)}")
             self._cleanup_connection()
             return False
 
@@ -44,23 +82,35 @@ class TrueDataFeed:
             
         self.stop_processing()
         self._cleanup_connection()
+        self._latest.clear()  # Stale session prices must not override the database
         self._connection_active = False
-        self.message_queue.put(("toast", "Disconnected from TrueData service", "🔌"))
+        self._notify("toast", "Disconnected from TrueData service", "🔌")
 
     def start_processing(self):
         """Enable data processing and storage"""
         if not self._connection_active:
-            self.message_queue.put(("error", "Not connected to TrueData service"))
+            self._notify("error", "Not connected to TrueData service")
             return False
             
+        DatabaseManager.prepare('truedata_insert', INSERT_TICKS_SQL, INSERT_TICKS_TYPES)
         self.req_ids = self.td_app.start_live_data(self.symbols)
         time.sleep(1)  # Allow connection to establish
-        self._last_data = {
-            req_id: deepcopy(self.td_app.live_data[req_id])
+        # Decide once whether the SDK hands out aware timestamps; naive ones are UTC
+        sample_ts = next((ts for ts in (
+            getattr(self.td_app.live_data[req_id], 'timestamp', None)
             for req_id in self.req_ids
-        }    
+        ) if ts is not None), None)
+        self._aware_ts = sample_ts is not None and sample_ts.tzinfo is not None
         self._processing_active = True
-        self.message_queue.put(("toast", "Data processing started", "▶️"))
+        # Each writer gets its own stop event, so a restart always pairs with a
+        # live loop; a writer that outlived its stop (e.g. stuck on the DB)
+        # is joined by its successor before the successor starts writing
+        self._stop_event = threading.Event()
+        self._writer_thread = threading.Thread(
+            target=self._writer_loop, args=(self._stop_event, self._writer_thread),
+            daemon=True, name="truedata-writer")
+        self._writer_thread.start()
+        self._notify("toast", "Data processing started", "▶️")
         return True
 
     def stop_processing(self):
@@ -68,9 +118,16 @@ class TrueDataFeed:
         if not self._processing_active:
             return
             
+        # Stop accepting ticks first, so the writer's final flush sees all of them
         self._processing_active = False
+        self._stop_event.set()
+        self._wake.set()
+        if self._writer_thread is not None:
+            self._writer_thread.join(timeout=2)
+            if not self._writer_thread.is_alive():
+                self._writer_thread = None
         self.td_app.stop_live_data(self.req_ids)
-        self.message_queue.put(("toast", "Data processing stopped", "⏹️"))
+        self._notify("toast", "Data processing stopped", "⏹️")
 
     def _cleanup_connection(self):
         """Internal cleanup method"""
@@ -86,83 +143,154 @@ class TrueDataFeed:
                 self.req_ids = []
                 time.sleep(0.5)
 
-    def check_for_updates(self):
-        """Check for new data (only processes if active)"""
-        if not self.is_connected() or not self._processing_active:
-            return False
-            
-        processed = False
-        for req_id in self.req_ids:
-            current_data = self.td_app.live_data[req_id]
-            if current_data != self._last_data.get(req_id):
-                self._process_data(current_data)
-                self._last_data[req_id] = deepcopy(current_data)
-                processed = True
-        return processed
+    def _writer_loop(self, stop_event, previous=None):
+        """Background thread: store queued ticks once a batch fills or flush_interval passes"""
+        if previous is not None:
+            previous.join()  # One writer at a time; ticks wait in the ring buffer
+        self._tune_writer_thread()
+        try:
+            DatabaseManager.bind_thread()
+        except Exception as e:
+            # Batches fall back to per-call pool connections
+            self._notify("error", f"Database error: {str(e)}")
+        try:
+            while not stop_event.is_set():
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self._flush_queue()
+            self._flush_queue()  # Flush whatever arrived before the stop
+        finally:
+            DatabaseManager.release_thread()
+
+    def _tune_writer_thread(self):
+        """Best-effort: pin the calling thread to writer_cpu and raise its priority"""
+        if self.writer_cpu is None or not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            # On Linux both calls apply to the calling thread only
+            os.sched_setaffinity(threading.get_native_id(), {self.writer_cpu})
+            os.nice(-5)
+        except (OSError, ValueError) as e:
+            print(f"Writer thread tuning skipped: {str(e)}")
+
+    def _on_tick(self, tick_data):
+        """TrueData trade callback (websocket thread)"""
+        if self._processing_active:
+            self._process_data(tick_data)
 
     def _process_data(self, tick_data):
         """Process incoming tick data"""
         try:
-            symbol = tick_data.symbol
-            price = getattr(tick_data, 'ltp', None)
-            timestamp = getattr(tick_data, 'timestamp', datetime.now(timezone.utc))
-            volume = getattr(tick_data, 'ttq', 0)
+            symbol, price, timestamp, volume = _extract_tick(tick_data)
+        except AttributeError as e:
+            self._notify("error", f"Data processing failed: {str(e)}")
+            return
             
-            if timestamp.tzinfo is None:
-                timestamp = timestamp.replace(tzinfo=timezone.utc)
-                
-            self.data_queue.put({
-                'symbol': symbol,
-                'ts': timestamp,
-                'ltp': price,
-                'volume': volume
-            })
-        except Exception as e:
-            self.message_queue.put(("error", f"Data processing failed: {str(e)}"))
+        # The ts column stores naive UTC; now() is only evaluated when needed
+        if timestamp is None:
+            timestamp = datetime.now(_UTC).replace(tzinfo=None)
+        elif self._aware_ts:
+            timestamp = timestamp.astimezone(_UTC).replace(tzinfo=None)
+        # The SDK reports ttq as a float; COPY into the BIGINT column needs "12345", not "12345.0"
+        if volume is not None:
+            volume = int(volume)
+            
+        self._latest[symbol] = (timestamp, price, volume)
+        self.last_tick_ts = timestamp
+        data_queue = self.data_queue
+        if len(data_queue) == data_queue.maxlen:
+            # The writer is stalled; the append below evicts the oldest tick
+            self._notify("warning", f"Tick buffer full ({data_queue.maxlen:,}); dropping oldest ticks")
+        data_queue.append((symbol, timestamp, price, volume))
+        if len(data_queue) >= BATCH_SIZE:
+            self._wake.set()
 
-    def process_queue(self):
-        """Process all items in queue"""
+    def _flush_queue(self):
+        """Store all queued ticks in batches (writer thread only)"""
         processed = 0
-        while not self.data_queue.empty():
-            try:
-                data = self.data_queue.get_nowait()
-                self._store_data(data)
-                processed += 1
-            except queue.Empty:
+        popleft = self.data_queue.popleft  # Bound once; the inner loop runs per tick
+        while True:
+            rows = []
+            append = rows.append
+            for _ in range(BATCH_SIZE):
+                try:
+                    append(popleft())
+                except IndexError:
+                    break
+            if not rows:
                 break
+            self._store_data(rows)
+            processed += len(rows)
         return processed
 
-    def _store_data(self, data):
-        """Store data in PostgreSQL"""
-        if not self._processing_active:
-            return
-            
-        query = """
-            INSERT INTO truedata_realtime 
-            (symbol, ts, ltp, volume)
-            VALUES (%(symbol)s, %(ts)s, %(ltp)s, %(volume)s)
-            ON CONFLICT (symbol, ts) DO NOTHING
-        """
+    def _store_data(self, rows):
+        """Store a batch of rows in PostgreSQL (the writer owns its own shutdown)"""
         try:
-            DatabaseManager.execute_query(query, data)
+            if len(rows) > COPY_THRESHOLD:
+                inserted = DatabaseManager.copy_rows('truedata_realtime', TICK_COLUMNS, rows)
+            else:
+                # One array per column, bound to the prepared statement
+                inserted = DatabaseManager.execute_prepared(
+                    'truedata_insert', [list(column) for column in zip(*rows)])
+            self.rows_written += inserted  # Excludes duplicates skipped by ON CONFLICT
         except Exception as e:
-            self.message_queue.put(("error", f"Database error: {str(e)}"))
+            self._notify("error", f"Database error: {str(e)}")
+
+    def _notify(self, kind, *body):
+        """Queue a UI message, dropping repeats of the previous one within MSG_DEDUP_WINDOW"""
+        key = (kind, body[0])
+        now = time.monotonic()
+        if key == self._last_msg_key and now - self._last_msg_time < MSG_DEDUP_WINDOW:
+            return
+        self._last_msg_key = key
+        self._last_msg_time = now
+        self.message_queue.put((kind, *body))
 
     def process_messages(self):
-        """Process UI messages"""
-        while not self.message_queue.empty():
-            msg_type, *content = self.message_queue.get_nowait()
+        """Process UI messages, at most one element per message type"""
+        toasts, errors, warnings = [], [], []
+        while True:
+            try:
+                msg_type, *content = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
             if msg_type == "toast":
-                st.toast(content[0], icon=content[1])
+                toasts.append(content)
             elif msg_type == "error":
-                st.error(content[0])
+                errors.append(content[0])
             elif msg_type == "warning":
-                st.warning(content[0])
+                warnings.append(content[0])
+                
+        for text, icon in toasts[-MAX_TOASTS:]:
+            st.toast(text, icon=icon)
+        if errors:
+            st.error("\n\n".join(errors))
+        if warnings:
+            st.warning("\n\n".join(warnings))
+
+    def latest_prices(self):
+        """Newest ltp per symbol seen this session (O(symbols), no database access)"""
+        return {symbol: tick[1] for symbol, tick in self._latest.copy().items()
+                if tick[1] is not None}
 
     def is_connected(self):
         """Check if connected to feed"""
         return self.td_app is not None
 
+    def is_connection_healthy(self):
+        """Check if the live websocket is up (probed at most every HEALTH_CHECK_INTERVAL)"""
+        now = time.monotonic()
+        if now - self._last_health_check < HEALTH_CHECK_INTERVAL:
+            return self._last_health
+        ws = getattr(self.td_app, 'live_websocket', None)
+        if ws is None:
+            self._last_health = self.is_connected()
+        else:
+            sock = getattr(ws, 'sock', None)
+            self._last_health = bool(sock is not None and sock.connected)
+        self._last_health_check = now
+        return self._last_health
+
     def is_processing(self):
         """Check if processing data"""
         return self._processing_active